@@ -1,17 +1,51 @@
 # Kontagent Analytics API interface
 
+import errno
 import random
 import urllib
 import httplib
+import socket
 import threading
+from collections import deque
 from urlparse import urlparse, urlunparse
 
 DIRECTED_VAL = 'd'
 UNDIRECTED_VAL = 'u'
 
+# Priority levels, lower values are more important.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Default message type to priority mapping used by AnalyticsInterface.
+# Message types not listed here are sent with PRIORITY_NORMAL.
+DEFAULT_PRIORITIES = {'apa' : PRIORITY_HIGH,
+                      'apr' : PRIORITY_HIGH,
+                      'pgr' : PRIORITY_LOW}
+
+# Default timeout in seconds for connections kept open by PrioritySender.
+DEFAULT_TIMEOUT = 10
+
+# Socket errors showing that the server closed a kept open connection.
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+# Default number of queries taken from each priority queue per draining cycle.
+DEFAULT_WEIGHTS = {PRIORITY_HIGH : 4,
+                   PRIORITY_NORMAL : 2,
+                   PRIORITY_LOW : 1}
+
+class AnalyticsResponseError(httplib.HTTPException):
+    """ Raised when the api server answers a query with a non 2xx status. """
+    def __init__(self, status, reason):
+        httplib.HTTPException.__init__(self, status, reason)
+        self.status = status
+        self.reason = reason
+
+
 class AnalyticsQuery:
     """ Class representing a single query to the Kontagent Analytics API. """
-    def __init__(self, query_string, api_server, query_type=None):
+    def __init__(self, query_string, api_server, query_type=None,
+                 priority=PRIORITY_NORMAL, sender=None, tenant=None):
         """ AnalyticsQuery constructor.
 
         Keyword arguments:
@@ -21,18 +55,40 @@ class AnalyticsQuery:
         query_type -- optional argument containing the type of the query, eg. 'ins'.
                       This is useful when you need to identify the type of a query
                       without having to parse the query string.
+        priority -- priority of the query, one of PRIORITY_HIGH, PRIORITY_NORMAL
+                    or PRIORITY_LOW.
+        sender -- optional PrioritySender used by thread_send(). When it is None
+                  every thread_send() call starts its own thread.
+        tenant -- optional tenant the query is accounted to by the sender,
+                  usually the api key.
 
         """
         self.query = query_string
         self.server =  api_server
         self.query_type = query_type
+        self.priority = priority
+        self.sender = sender
+        self.tenant = tenant
         
-    def send(self):
+    def send(self, connection=None):
         """Sends the query to the api server
 
         Returns HTTP response.
 
+        Keyword arguments:
+        connection -- optional open httplib.HTTPConnection to the api server.
+                      It is left open so it can be reused for further queries,
+                      and AnalyticsResponseError is raised if the response
+                      status is not 2xx.
+
         """
+        if connection is not None:
+            connection.request("GET", self.query)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status < 200 or response.status >= 300:
+                raise AnalyticsResponseError(response.status, response.reason)
+            return data
         conn = httplib.HTTPConnection(self.server)
         conn.request("GET", self.query)
         response = conn.getresponse()
@@ -43,15 +99,265 @@ class AnalyticsQuery:
     def thread_send(self):
         """Sends the query to the api server in a seperate thread.
 
+        If the query has a sender it is queued on the sender according to
+        its priority instead, and may be shed if the sender is full.
+
         Returns instantly.
 
-        """                
+        """
+        if self.sender is not None:
+            self.sender.enqueue(self)
+            return
         t = threading.Thread(target=self.send)
         t.setDaemon(True)
         t.start()
         return
 
 
+class PrioritySender:
+    """Sends AnalyticsQuery objects from background threads by priority.
+
+    Each priority level has its own queue. Worker threads drain the queues
+    in weighted round robin order, so higher priority queries are sent more
+    often while lower priority queries are not starved. When the total number
+    of queued queries reaches capacity, the oldest query of the lowest
+    priority below the incoming one is dropped to make room; if there is none,
+    the incoming query is dropped.
+
+    Queries are accounted to their tenant. A tenant can be given a quota,
+    the maximum number of its queries waiting to be sent; a tenant over its
+    quota has its own lower priority queries shed in the same way. Counts
+    of queued, sent, failed and dropped queries are kept for each tenant.
+
+    Each worker thread keeps one connection open per api server. A query
+    that fails because the server closed a reused connection while idle is
+    retried once on a new connection. A query counts as failed if it could
+    not be sent or the server answered with a non 2xx status.
+
+    Usage:
+     sender = PrioritySender(capacity=500)
+     analytics_interface = AnalyticsInterface('test-server.kontagent.com',
+                                              'XXXXXXXX', sender=sender)
+
+    """
+
+    def __init__(self, capacity=1000, weights=None, workers=1, quotas=None,
+                 timeout=DEFAULT_TIMEOUT):
+        """ PrioritySender constructor.
+
+        Keyword arguments:
+        capacity -- maximum number of queries waiting to be sent, over all priorities.
+                    Raises ValueError if it is below 1.
+        weights -- dictionary mapping priority to the number of queries sent from
+                   that priority per draining cycle, defaults to DEFAULT_WEIGHTS.
+                   Raises ValueError if it is empty or a weight is not an
+                   integer of at least 1.
+        workers -- number of worker threads sending queries
+        quotas -- dictionary mapping tenant to the maximum number of its
+                  queries waiting to be sent
+        timeout -- timeout in seconds for connections to the api server
+
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        if capacity < 1:
+            raise ValueError, "capacity must be at least 1, got %r" % (capacity,)
+        if not weights:
+            raise ValueError, "at least one priority weight is required"
+        for p, weight in weights.items():
+            if not isinstance(weight, (int, long)) or weight < 1:
+                raise ValueError, "weight for priority %r must be an integer of at least 1, got %r" % (p, weight)
+        if quotas is None:
+            quotas = {}
+        self.capacity = capacity
+        self.timeout = timeout
+        self.quotas = dict(quotas)
+        self.pending = {}
+        self.metrics = {}
+        self.weights = dict(weights)
+        self.queues = dict((p, deque()) for p in self.weights)
+        self.dropped = dict((p, 0) for p in self.weights)
+        self.size = 0
+        self.schedule = []
+        for p in sorted(self.weights):
+            self.schedule.extend([p] * self.weights[p])
+        self.position = 0
+        self.condition = threading.Condition()
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.setDaemon(True)
+            t.start()
+
+    def enqueue(self, query):
+        """Queues a query to be sent according to its priority.
+
+        Returns True if the query was queued, False if it was shed.
+        Raises ValueError if the query's priority has no weight.
+
+        Keyword arguments:
+        query -- AnalyticsQuery to send
+
+        """
+        priority = query.priority
+        self.check_priority(priority)
+        tenant = query.tenant
+        self.condition.acquire()
+        try:
+            quota = self.quotas.get(tenant)
+            if quota is not None and self.pending.get(tenant, 0) >= quota:
+                full = not self.shed(priority, tenant, True)
+            elif self.size >= self.capacity:
+                full = not self.shed(priority, tenant, False)
+            else:
+                full = False
+            if full:
+                self.dropped[priority] += 1
+                self.count(tenant, 'dropped')
+                return False
+            self.queues[priority].append(query)
+            self.size += 1
+            self.pending[tenant] = self.pending.get(tenant, 0) + 1
+            self.count(tenant, 'queued')
+            self.condition.notify()
+            return True
+        finally:
+            self.condition.release()
+
+    def shed(self, priority, tenant, same_tenant):
+        """Drops the oldest queued query of the lowest priority below priority.
+
+        Only queries of tenant are considered when same_tenant is true.
+        The caller must hold the condition.
+
+        Returns True if a query was dropped.
+
+        """
+        for p in sorted(self.queues, reverse=True):
+            if p <= priority:
+                break
+            for queued in self.queues[p]:
+                if not same_tenant or queued.tenant == tenant:
+                    self.queues[p].remove(queued)
+                    self.dropped[p] += 1
+                    self.size -= 1
+                    self.pending[queued.tenant] -= 1
+                    self.count(queued.tenant, 'dropped')
+                    return True
+        return False
+
+    def set_quota(self, tenant, quota):
+        """Sets the maximum number of a tenant's queries waiting to be sent.
+
+        A quota of None removes the tenant's quota.
+
+        """
+        self.condition.acquire()
+        try:
+            if quota is None:
+                self.quotas.pop(tenant, None)
+            else:
+                self.quotas[tenant] = quota
+        finally:
+            self.condition.release()
+
+    def check_priority(self, priority):
+        """Raises ValueError if there is no queue for a priority."""
+        if priority not in self.queues:
+            raise ValueError, "priority %r has no weight" % (priority,)
+
+    def next_query(self):
+        """Waits for and removes the next query to send, in weighted order."""
+        self.condition.acquire()
+        try:
+            while self.size == 0:
+                self.condition.wait()
+            while True:
+                p = self.schedule[self.position]
+                self.position = (self.position + 1) % len(self.schedule)
+                if self.queues[p]:
+                    self.size -= 1
+                    query = self.queues[p].popleft()
+                    self.pending[query.tenant] -= 1
+                    return query
+        finally:
+            self.condition.release()
+
+    def count(self, tenant, name):
+        """Increments a per tenant counter, the caller must hold the condition."""
+        if tenant not in self.metrics:
+            self.metrics[tenant] = {'queued' : 0, 'sent' : 0,
+                                    'failed' : 0, 'dropped' : 0}
+        self.metrics[tenant][name] += 1
+
+    def tenant_metrics(self, tenant):
+        """Returns a copy of the counters kept for a tenant.
+
+        The dictionary has 'queued', 'sent', 'failed', 'dropped' and
+        'pending' keys.
+
+        """
+        self.condition.acquire()
+        try:
+            metrics = dict(self.metrics.get(tenant, {'queued' : 0, 'sent' : 0,
+                                                     'failed' : 0, 'dropped' : 0}))
+            metrics['pending'] = self.pending.get(tenant, 0)
+            return metrics
+        finally:
+            self.condition.release()
+
+    def send(self, query, connections):
+        """Sends a query on the worker's connection to its api server.
+
+        A connection that fails is closed and removed from connections.
+        If it had already been used and the server closed it, the query is
+        retried once on a new connection. Timeouts are not retried, as the
+        server may already have accepted the query.
+
+        Returns 'sent' if the server answered with a 2xx status, otherwise
+        'failed'.
+
+        Keyword arguments:
+        query -- AnalyticsQuery to send
+        connections -- dictionary mapping api server to the worker's open connection
+
+        """
+        reused = query.server in connections
+        while True:
+            conn = connections.get(query.server)
+            if conn is None:
+                conn = httplib.HTTPConnection(query.server, timeout=self.timeout)
+                connections[query.server] = conn
+            try:
+                query.send(conn)
+                return 'sent'
+            except Exception, e:
+                conn.close()
+                del connections[query.server]
+                if not reused or not self.connection_closed(e):
+                    return 'failed'
+                reused = False
+
+    def connection_closed(self, error):
+        """Returns True if error shows the server closed a kept open connection."""
+        if isinstance(error, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+            return True
+        if isinstance(error, socket.timeout):
+            return False
+        return isinstance(error, socket.error) and error.errno in CLOSED_ERRNOS
+
+    def run(self):
+        """Worker loop, sends queued queries until the process exits."""
+        connections = {}
+        while True:
+            query = self.next_query()
+            result = self.send(query, connections)
+            self.condition.acquire()
+            try:
+                self.count(query.tenant, result)
+            finally:
+                self.condition.release()
+
+
 class AnalyticsInterface:
     """The AnalyticsInterface class is a factory for AnalyticsQuery objects.
 
@@ -59,15 +365,34 @@ class AnalyticsInterface:
     address, api key, and server version, to allow for easy construction
     of AnalyticsQuery objects.
 
+    Each message type is given a priority, looked up in the priorities
+    dictionary and defaulting to PRIORITY_NORMAL. When a PrioritySender is
+    given, thread_send() on the constructed queries goes through its queues,
+    and every configured priority must have a weight in that sender.
+
     Usage:
      analytics_interface = AnalyticsInterface('test-server.kontagent.com')
 
     """
     
-    def __init__(self, api_server, api_key, api_version="v1"):       
+    def __init__(self, api_server, api_key, api_version="v1",
+                 priorities=None, sender=None):
+        if priorities is None:
+            priorities = DEFAULT_PRIORITIES
         self.server = api_server
         self.key = api_key
         self.version = api_version
+        self.priorities = dict(priorities)
+        self.sender = sender
+        self.prefix = "/api/" + self.version + "/" + self.key + "/"
+        if sender is not None:
+            sender.check_priority(PRIORITY_NORMAL)
+            for priority in self.priorities.values():
+                sender.check_priority(priority)
+
+    def priority(self, msg_type):
+        """Returns the priority configured for a message type."""
+        return self.priorities.get(msg_type, PRIORITY_NORMAL)
 
     def construct_query(self, msg_type, parameters):
         """ Constructs an AnalyticsQuery object with a query string in the form:
@@ -80,9 +405,9 @@ class AnalyticsInterface:
         parameters --  a dictionary containing the query parameters                       
 
         """
-        return AnalyticsQuery("/api/" + self.version + "/" + self.key \
-                         + "/" + msg_type +"/?" + urllib.urlencode(parameters),
-                         self.server, msg_type)
+        return AnalyticsQuery(self.prefix + msg_type + "/?" + urllib.urlencode(parameters),
+                         self.server, msg_type, self.priority(msg_type),
+                         self.sender, self.key)
 
                            
     def user_info(self, uid, birthyear=None, gender=None, city=None,
@@ -222,6 +547,83 @@ class AnalyticsInterface:
 
         return self.construct_query("gci", params)
 
+
+class AnalyticsRegistry:
+    """The AnalyticsRegistry class holds one AnalyticsInterface per api key.
+
+    All interfaces in a registry share the same PrioritySender, so the
+    events of every tenant go through one set of queues, worker threads
+    and connections. Each tenant can have its own quota of queued events,
+    and its counters are available through metrics().
+
+    Usage:
+     registry = AnalyticsRegistry('test-server.kontagent.com', workers=4)
+     registry.register('XXXXXXXX', quota=200)
+     registry.interface('XXXXXXXX').page_request(uid, uri).thread_send()
+
+    """
+
+    def __init__(self, api_server, api_version="v1", priorities=None,
+                 capacity=1000, weights=None, workers=1, sender=None,
+                 timeout=DEFAULT_TIMEOUT):
+        """ AnalyticsRegistry constructor.
+
+        Keyword arguments:
+        api_server -- api server shared by all tenants, eg. 'api.geo.kontagent.net'
+        api_version -- api version shared by all tenants
+        priorities -- message type to priority mapping, see AnalyticsInterface
+        capacity, weights, workers, timeout -- passed to the PrioritySender
+                                               created when sender is not given
+        sender -- optional PrioritySender to share instead of creating one
+
+        """
+        if sender is None:
+            sender = PrioritySender(capacity, weights, workers, timeout=timeout)
+        self.server = api_server
+        self.version = api_version
+        self.priorities = priorities
+        self.sender = sender
+        self.interfaces = {}
+        self.lock = threading.Lock()
+
+    def register(self, api_key, quota=None):
+        """Registers a tenant and returns its AnalyticsInterface.
+
+        Keyword arguments:
+        api_key -- Kontagent API key of the tenant
+        quota -- optional maximum number of the tenant's events waiting to be
+                 sent. When None any quota set before is kept, use set_quota()
+                 to remove it.
+
+        """
+        if quota is not None:
+            self.sender.set_quota(api_key, quota)
+        self.lock.acquire()
+        try:
+            if api_key not in self.interfaces:
+                self.interfaces[api_key] = AnalyticsInterface(self.server, api_key,
+                                                              self.version,
+                                                              self.priorities,
+                                                              self.sender)
+            return self.interfaces[api_key]
+        finally:
+            self.lock.release()
+
+    def interface(self, api_key):
+        """Returns the AnalyticsInterface for an api key, registering it if needed."""
+        interface = self.interfaces.get(api_key)
+        if interface is None:
+            interface = self.register(api_key)
+        return interface
+
+    def set_quota(self, api_key, quota):
+        """Sets or, when quota is None, removes the quota of an api key."""
+        self.sender.set_quota(api_key, quota)
+
+    def metrics(self, api_key):
+        """Returns the sender counters for an api key, see PrioritySender.tenant_metrics()."""
+        return self.sender.tenant_metrics(api_key)
+
             
 def construct_query(api_key, api_server, api_version, msg_type, parameters):
     """Constructs a generic query to the analytics API in the form:
@@ -1,4 +1,5 @@
-from kontagent import AnalyticsInterface, strip_params
+from kontagent import AnalyticsInterface, AnalyticsRegistry, DEFAULT_TIMEOUT, strip_params
+import threading
 from django.http import HttpResponse
 from django.conf import settings
 
@@ -44,6 +45,25 @@ def facebook_redirect(url):
     response = HttpResponse("<fb:redirect url=\"%s\"/>" % url)
     return response
 
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """ Returns the AnalyticsRegistry shared by all middleware instances in this process. """
+    global _registry
+    _registry_lock.acquire()
+    try:
+        if _registry is None:
+            _registry = AnalyticsRegistry(settings.KONTAGENT_API_SERVER,
+                                          priorities=getattr(settings, 'KONTAGENT_PRIORITIES', None),
+                                          capacity=settings.KONTAGENT_QUEUE_CAPACITY,
+                                          weights=getattr(settings, 'KONTAGENT_QUEUE_WEIGHTS', None),
+                                          workers=getattr(settings, 'KONTAGENT_QUEUE_WORKERS', 1),
+                                          timeout=getattr(settings, 'KONTAGENT_QUEUE_TIMEOUT', DEFAULT_TIMEOUT))
+        return _registry
+    finally:
+        _registry_lock.release()
+
 
 class KontagentMiddleware:
     """ This is django compatible middleware.
@@ -53,6 +73,11 @@ class KontagentMiddleware:
 
     Note: currently facebook signature checking is not done.
 
+    To track several apps in one process, set KONTAGENT_API_KEYS to a
+    dictionary mapping each app's facebook API key to its Kontagent API key.
+    Each request is then tracked under the Kontagent API key matching its
+    fb_sig_api_key parameter, and requests that match none are not tracked.
+
     """
 
     def __init__(self, auto_redirect=True):
@@ -66,23 +91,55 @@ class KontagentMiddleware:
                          after following a link with kontagent params.
         """
         self.redirect = auto_redirect
-        self.analytics_interface = AnalyticsInterface(settings.KONTAGENT_API_SERVER,
-                                                      settings.KONTAGENT_API_KEY)
+        self.api_keys = getattr(settings, 'KONTAGENT_API_KEYS', None)
+        if self.api_keys is None:
+            api_keys = [settings.KONTAGENT_API_KEY]
+        else:
+            api_keys = self.api_keys.values()
+        self.interfaces = {}
+        for api_key in api_keys:
+            if getattr(settings, 'KONTAGENT_QUEUE_CAPACITY', None) is not None:
+                quotas = getattr(settings, 'KONTAGENT_QUOTAS', {})
+                if api_key in quotas:
+                    get_registry().set_quota(api_key, quotas[api_key])
+                self.interfaces[api_key] = get_registry().interface(api_key)
+            else:
+                self.interfaces[api_key] = AnalyticsInterface(settings.KONTAGENT_API_SERVER,
+                                                              api_key,
+                                                              priorities=getattr(settings, 'KONTAGENT_PRIORITIES', None))
+
+    def get_analytics_interface(self, request):
+        """ Returns the AnalyticsInterface to track a request with.
+
+        Returns None if KONTAGENT_API_KEYS is set and has no Kontagent API key
+        for the request's fb_sig_api_key.
 
+        """
+        if self.api_keys is None:
+            return self.interfaces[settings.KONTAGENT_API_KEY]
+        fb_api_key = request.POST.get('fb_sig_api_key', request.GET.get('fb_sig_api_key'))
+        api_key = self.api_keys.get(fb_api_key)
+        if api_key is None:
+            return None
+        return self.interfaces[api_key]
 
     def process_request(self, request):
+        analytics_interface = self.get_analytics_interface(request)
+        if analytics_interface is None:
+            return None
+
         # Check for app removal
         if 'fb_sig_uninstall' in request.POST and get_uid(request) is not None:
             if request.POST['fb_sig_uninstall'] == '1':
-                self.analytics_interface.application_removed(get_uid(request)).thread_send()
+                analytics_interface.application_removed(get_uid(request)).thread_send()
 
         # Check for app added
         #and 'kt_ut' in request.GET \
         if 'installed' in request.GET and request.GET['installed'] == '1' \
                and get_uid(request) is not None:
             kt_params = get_kt_params(request)
-            self.analytics_interface.application_added(uid=get_uid(request),
-                                                       trackingTag=kt_params['u']).thread_send()
+            analytics_interface.application_added(uid=get_uid(request),
+                                                  trackingTag=kt_params['u']).thread_send()
 
         # Process tracking params
         kt_type = request.GET.get('kt_type', None)
@@ -94,13 +151,13 @@ class KontagentMiddleware:
                     kt_params = get_kt_params(request)
                     uid = get_uid(request)
                         
-                    self.analytics_interface.notification_response(installed=installed,
-                                                                   recipient_id=uid,
-                                                                   tracking_tag=kt_params['u'],
-                                                                   template_id=kt_params['t'],
-                                                                   subtype_1=kt_params['st1'],
-                                                                   subtype_2=kt_params['st2'],
-                                                                   subtype_3=kt_params['st3']).thread_send()
+                    analytics_interface.notification_response(installed=installed,
+                                                              recipient_id=uid,
+                                                              tracking_tag=kt_params['u'],
+                                                              template_id=kt_params['t'],
+                                                              subtype_1=kt_params['st1'],
+                                                              subtype_2=kt_params['st2'],
+                                                              subtype_3=kt_params['st3']).thread_send()
                     
                     if self.redirect:
                         return facebook_redirect(callback_to_facebook(strip_params(request.build_absolute_uri())))
@@ -113,13 +170,13 @@ class KontagentMiddleware:
                     uids = request.POST.getlist('ids[]')
                     kt_params = get_kt_params(request)
 
-                    self.analytics_interface.invite_sent(uid=uid,
-                                                         recipients=uids,
-                                                         tracking_tag=kt_params['u'],
-                                                         template_id=kt_params['t'],
-                                                         subtype_1=kt_params['st1'],
-                                                         subtype_2=kt_params['st2'],
-                                                         subtype_3=kt_params['st3']).thread_send()
+                    analytics_interface.invite_sent(uid=uid,
+                                                    recipients=uids,
+                                                    tracking_tag=kt_params['u'],
+                                                    template_id=kt_params['t'],
+                                                    subtype_1=kt_params['st1'],
+                                                    subtype_2=kt_params['st2'],
+                                                    subtype_3=kt_params['st3']).thread_send()
 
             # Invite click
             elif kt_type == "in":
@@ -128,13 +185,13 @@ class KontagentMiddleware:
                     kt_params = get_kt_params(request)
                     uid = get_uid(request)
 
-                    self.analytics_interface.invite_response(installed=installed,
-                                                             tracking_tag=kt_params['u'],
-                                                             template_id=kt_params['t'],
-                                                             recipient_id=uid,
-                                                             subtype_1=kt_params['st1'],
-                                                             subtype_2=kt_params['st2'],
-                                                             subtype_3=kt_params['st3']).thread_send()
+                    analytics_interface.invite_response(installed=installed,
+                                                        tracking_tag=kt_params['u'],
+                                                        template_id=kt_params['t'],
+                                                        recipient_id=uid,
+                                                        subtype_1=kt_params['st1'],
+                                                        subtype_2=kt_params['st2'],
+                                                        subtype_3=kt_params['st3']).thread_send()
                     if self.redirect:
                         return facebook_redirect(callback_to_facebook(strip_params(request.build_absolute_uri())))
 
@@ -145,12 +202,12 @@ class KontagentMiddleware:
                     kt_params = get_kt_params(request)
                     uid = get_uid(request)
                     
-                    self.analytics_interface.email_response(installed=installed,
-                                                            tracking_tag=kt_params['u'],
-                                                            recipient_id=uid,
-                                                            subtype_1=kt_params['st1'],
-                                                            subtype_2=kt_params['st2'],
-                                                            subtype_3=kt_params['st3']).thread_send()
+                    analytics_interface.email_response(installed=installed,
+                                                       tracking_tag=kt_params['u'],
+                                                       recipient_id=uid,
+                                                       subtype_1=kt_params['st1'],
+                                                       subtype_2=kt_params['st2'],
+                                                       subtype_3=kt_params['st3']).thread_send()
                     if self.redirect:
                         return facebook_redirect(callback_to_facebook(strip_params(request.build_absolute_uri())))
              
@@ -166,13 +223,13 @@ class KontagentMiddleware:
                 uid = get_uid(request)
                 short_tag = generate_short_tag()
 
-                self.analytics_interface.ucc(uid=uid,
-                                             type=kt_type,
-                                             installed=installed,
-                                             short_tracking_tag=short_tag,
-                                             subtype_1=kt_params['st1'],
-                                             subtype_2=kt_params['st2'],
-                                             subtype_3=kt_params['st3']).thread_send()
+                analytics_interface.ucc(uid=uid,
+                                        type=kt_type,
+                                        installed=installed,
+                                        short_tracking_tag=short_tag,
+                                        subtype_1=kt_params['st1'],
+                                        subtype_2=kt_params['st2'],
+                                        subtype_3=kt_params['st3']).thread_send()
                 if self.redirect:
                     return facebook_redirect(callback_to_facebook(strip_params(request.build_absolute_uri())))
         
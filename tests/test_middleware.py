@@ -0,0 +1,52 @@
+import unittest
+
+try:
+    from django.conf import settings
+except ImportError:
+    settings = None
+
+
+@unittest.skipIf(settings is None, "Django is not installed")
+class MiddlewareRoutingTest(unittest.TestCase):
+    """ Tests for tracking several apps with one KontagentMiddleware. """
+
+    def setUp(self):
+        if not settings.configured:
+            settings.configure()
+        settings.FACEBOOK_APP_NAME = 'yourapp'
+        settings.FACEBOOK_CALLBACK_HOST = 'http://localhost'
+        settings.FACEBOOK_CALLBACK_PATH = '/fb/canvas/'
+        settings.KONTAGENT_API_SERVER = 'localhost'
+        settings.KONTAGENT_API_KEYS = {'fbA' : 'A', 'fbB' : 'B'}
+        settings.KONTAGENT_QUEUE_CAPACITY = 100
+        settings.KONTAGENT_QUEUE_WORKERS = 0
+        settings.KONTAGENT_QUOTAS = {'B' : 5}
+
+        from django.test.client import RequestFactory
+        from kontagent import middleware
+        middleware._registry = None
+        self.factory = RequestFactory()
+        self.middleware = middleware.KontagentMiddleware()
+        self.registry = middleware.get_registry()
+
+    def uninstall(self, fb_api_key):
+        request = self.factory.post('/', {'fb_sig_api_key' : fb_api_key,
+                                          'fb_sig_user' : '1',
+                                          'fb_sig_uninstall' : '1'})
+        return self.middleware.process_request(request)
+
+    def test_routes_by_api_key(self):
+        self.uninstall('fbA')
+        self.uninstall('fbA')
+        self.uninstall('fbB')
+        self.assertEqual(self.registry.metrics('A')['queued'], 2)
+        self.assertEqual(self.registry.metrics('B')['queued'], 1)
+        self.assertEqual(self.registry.sender.quotas, {'B' : 5})
+
+    def test_unknown_api_key(self):
+        self.assertEqual(self.uninstall('fbC'), None)
+        self.assertEqual(self.registry.sender.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
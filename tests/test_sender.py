@@ -0,0 +1,203 @@
+import errno
+import httplib
+import socket
+import threading
+import unittest
+
+import kontagent
+from kontagent import AnalyticsInterface, AnalyticsRegistry, PrioritySender, \
+     PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+class PrioritySenderTest(unittest.TestCase):
+    """ Tests for PrioritySender, run without worker threads or network. """
+
+    def test_weighted_drain_order(self):
+        sender = PrioritySender(weights={PRIORITY_HIGH : 2, PRIORITY_NORMAL : 1,
+                                         PRIORITY_LOW : 1},
+                                workers=0)
+        interface = AnalyticsInterface('localhost', 'KEY',
+                                       priorities={'apa' : PRIORITY_HIGH,
+                                                   'pgr' : PRIORITY_LOW},
+                                       sender=sender)
+        for i in range(3):
+            interface.page_request(i, '/').thread_send()
+            interface.application_added(i).thread_send()
+        order = [sender.next_query().query_type for i in range(6)]
+        self.assertEqual(order, ['apa', 'apa', 'pgr', 'apa', 'pgr', 'pgr'])
+
+    def test_shed_lowest_priority_first(self):
+        sender = PrioritySender(capacity=2, workers=0)
+        interface = AnalyticsInterface('localhost', 'KEY', sender=sender)
+        self.assertTrue(sender.enqueue(interface.page_request(1, '/')))
+        self.assertTrue(sender.enqueue(interface.user_info(2)))
+        self.assertTrue(sender.enqueue(interface.application_added(3)))
+        self.assertFalse(sender.enqueue(interface.page_request(4, '/')))
+        self.assertEqual(sender.dropped, {PRIORITY_HIGH : 0,
+                                          PRIORITY_NORMAL : 0,
+                                          PRIORITY_LOW : 2})
+        order = [sender.next_query().query_type for i in range(2)]
+        self.assertEqual(order, ['apa', 'cpu'])
+
+    def test_invalid_weights(self):
+        self.assertRaises(ValueError, PrioritySender, weights={}, workers=0)
+        self.assertRaises(ValueError, PrioritySender,
+                          weights={PRIORITY_HIGH : 1, PRIORITY_NORMAL : 1,
+                                   PRIORITY_LOW : 0},
+                          workers=0)
+        self.assertRaises(ValueError, PrioritySender,
+                          weights={PRIORITY_HIGH : 1.5, PRIORITY_NORMAL : 1,
+                                   PRIORITY_LOW : 1},
+                          workers=0)
+        self.assertRaises(ValueError, PrioritySender, capacity=0, workers=0)
+
+    def test_priority_without_weight(self):
+        sender = PrioritySender(weights={PRIORITY_HIGH : 4, PRIORITY_NORMAL : 2},
+                                workers=0)
+        self.assertRaises(ValueError, AnalyticsInterface, 'localhost', 'KEY',
+                          sender=sender)
+        query = kontagent.AnalyticsQuery('/', 'localhost', 'pgr', PRIORITY_LOW)
+        self.assertRaises(ValueError, sender.enqueue, query)
+
+
+class TenantTest(unittest.TestCase):
+    """ Tests for per tenant quotas and metrics. """
+
+    def setUp(self):
+        self.registry = AnalyticsRegistry('localhost', workers=0)
+        self.sender = self.registry.sender
+
+    def test_shared_interfaces(self):
+        a = self.registry.register('A')
+        self.assertTrue(self.registry.interface('A') is a)
+        self.assertTrue(a.sender is self.registry.interface('B').sender)
+        self.assertEqual(a.application_removed(1).query, '/api/v1/A/apr/?s=1')
+
+    def test_quota_sheds_own_lower_priority(self):
+        a = self.registry.register('A', quota=2)
+        b = self.registry.interface('B')
+        self.assertTrue(self.sender.enqueue(b.page_request(1, '/')))
+        self.assertTrue(self.sender.enqueue(a.page_request(2, '/')))
+        self.assertTrue(self.sender.enqueue(a.page_request(3, '/')))
+        self.assertTrue(self.sender.enqueue(a.application_added(4)))
+        self.assertTrue(self.sender.enqueue(a.application_removed(5)))
+        self.assertFalse(self.sender.enqueue(a.application_removed(6)))
+        self.assertEqual(self.registry.metrics('A'),
+                         {'queued' : 4, 'sent' : 0, 'failed' : 0,
+                          'dropped' : 3, 'pending' : 2})
+        self.assertEqual(self.registry.metrics('B'),
+                         {'queued' : 1, 'sent' : 0, 'failed' : 0,
+                          'dropped' : 0, 'pending' : 1})
+        order = [self.sender.next_query().query for i in range(3)]
+        self.assertEqual(order, ['/api/v1/A/apa/?s=4', '/api/v1/A/apr/?s=5',
+                                 '/api/v1/B/pgr/?s=1&u=%2F'])
+        self.assertEqual(self.registry.metrics('A')['pending'], 0)
+
+    def test_register_keeps_quota(self):
+        a = self.registry.register('A', quota=1)
+        self.assertTrue(self.registry.register('A') is a)
+        self.assertTrue(self.sender.enqueue(a.page_request(1, '/')))
+        self.assertFalse(self.sender.enqueue(a.page_request(2, '/')))
+        self.registry.set_quota('A', None)
+        self.assertTrue(self.sender.enqueue(a.page_request(3, '/')))
+
+
+class ReconnectTest(unittest.TestCase):
+    """ Tests for sending on kept open connections. """
+
+    class Query:
+        server = 'localhost'
+        tenant = None
+
+        def __init__(self, fail=(), error=None, fail_all=False):
+            self.fail = fail
+            self.fail_all = fail_all
+            self.error = error or httplib.BadStatusLine('')
+            self.connections = []
+
+        def send(self, connection):
+            self.connections.append(connection)
+            if self.fail_all or connection in self.fail:
+                raise self.error
+            return 'ok'
+
+    class Connection:
+        reason = ''
+
+        def __init__(self, status=200):
+            self.status = status
+
+        def request(self, method, url):
+            pass
+
+        def getresponse(self):
+            return self
+
+        def read(self):
+            return ''
+
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.sender = PrioritySender(workers=0)
+
+    def test_send_new_connection(self):
+        connections = {}
+        query = self.Query()
+        self.assertEqual(self.sender.send(query, connections), 'sent')
+        self.assertTrue(connections['localhost'] is query.connections[0])
+        self.assertEqual(connections['localhost'].timeout, kontagent.DEFAULT_TIMEOUT)
+
+    def test_retry_reused_connection(self):
+        stale = self.Connection()
+        connections = {'localhost' : stale}
+        query = self.Query([stale])
+        self.assertEqual(self.sender.send(query, connections), 'sent')
+        self.assertEqual(len(query.connections), 2)
+        self.assertTrue(connections['localhost'] is query.connections[1])
+
+    def test_retry_connection_reset(self):
+        stale = self.Connection()
+        query = self.Query([stale], socket.error(errno.ECONNRESET, 'reset'))
+        self.assertEqual(self.sender.send(query, {'localhost' : stale}), 'sent')
+        self.assertEqual(len(query.connections), 2)
+
+    def test_no_retry_on_timeout(self):
+        stale = self.Connection()
+        connections = {'localhost' : stale}
+        query = self.Query([stale], socket.timeout('timed out'))
+        self.assertEqual(self.sender.send(query, connections), 'failed')
+        self.assertEqual(len(query.connections), 1)
+        self.assertEqual(connections, {})
+
+    def test_no_retry_on_new_connection(self):
+        query = self.Query(fail_all=True)
+        self.assertEqual(self.sender.send(query, {}), 'failed')
+        self.assertEqual(len(query.connections), 1)
+
+    def test_error_status(self):
+        query = AnalyticsInterface('localhost', 'KEY').application_added(1)
+        self.assertEqual(query.send(self.Connection()), '')
+        self.assertRaises(kontagent.AnalyticsResponseError, query.send,
+                          self.Connection(500))
+        connections = {'localhost' : self.Connection(500)}
+        self.assertEqual(self.sender.send(query, connections), 'failed')
+        self.assertEqual(connections, {})
+
+
+class ThreadSendTest(unittest.TestCase):
+    """ Tests for AnalyticsQuery.thread_send() without a sender. """
+
+    def test_thread_per_query(self):
+        sent = threading.Event()
+        query = AnalyticsInterface('localhost', 'KEY').page_request(1, '/')
+        self.assertEqual(query.sender, None)
+        query.send = sent.set
+        query.thread_send()
+        sent.wait(5)
+        self.assertTrue(sent.isSet())
+
+
+if __name__ == '__main__':
+    unittest.main()